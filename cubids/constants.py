@@ -6,6 +6,12 @@
 ID_VARS = set(["EntitySet", "ParamGroup", "FilePath"])
 # Entities that should not be used to group parameter sets
 NON_KEY_ENTITIES = set(["subject", "session", "extension"])
+# File extensions that identify NIfTI images
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+# Datatype directories with their own entries in the grouping config
+MODALITIES = set(["anat", "dwi", "fmap", "func", "perf"])
+# Number of threads used to read or stat many files concurrently
+IO_WORKERS = 16
 # Multi-dimensional keys SliceTiming  XXX: what is this line about?
 # List of metadata fields and parameters (calculated by CuBIDS)
 # Not sure what this specific list is used for.
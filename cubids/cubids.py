@@ -1,12 +1,16 @@
 """Main module."""
 
 import csv
+import gzip
+import heapq
 import json
 import os
 import re
 import subprocess
 import warnings
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 from pathlib import Path
 from shutil import copyfile, copytree
 
@@ -18,12 +22,22 @@ import numpy as np
 import pandas as pd
 from bids.layout import parse_file_entities
 from bids.utils import listify
-from sklearn.cluster import AgglomerativeClustering
 from tqdm import tqdm
 
 from cubids.config import load_config
-from cubids.constants import ID_VARS, NON_KEY_ENTITIES
-from cubids.metadata_merge import check_merging_operations, group_by_acquisition_sets
+from cubids.constants import (
+    ID_VARS,
+    IO_WORKERS,
+    MODALITIES,
+    NIFTI_EXTENSIONS,
+    NON_KEY_ENTITIES,
+)
+from cubids.metadata_merge import (
+    check_merging_operations,
+    group_by_acquisition_sets,
+    merge_json_into_json,
+)
+from cubids.utils import _clone_file, _iter_bids_files, _iter_json_files, _load_json
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 bids.config.set_option("extension_initial_dot", True)
@@ -103,6 +117,9 @@ class CuBIDS(object):
         self.old_filenames = []  # files whose entity sets changed
         self.new_filenames = []  # new filenames for files to change
         self.IF_rename_paths = []  # fmap jsons with rename intended fors
+        self._if_sidecars = None  # fmap jsons loaded while batching IntendedFor renames
+        self._if_sidecars_changed = set()  # fmap jsons to write when the batch is done
+        self._if_session_files = {}  # fmap jsons in each session while batching
         self.grouping_config = load_config(grouping_config)
         self.acq_group_level = acq_group_level
         self.scans_txt = None  # txt file of scans to purge (for purge only)
@@ -132,6 +149,9 @@ class CuBIDS(object):
         """Reset the BIDS layout.
 
         This sets the ``_layout`` attribute to a new :obj:`bids.layout.BIDSLayout` object.
+        Methods that only edit sidecars don't need to call this, because metadata isn't indexed.
+        Methods that rename or remove files set ``_layout`` to None instead,
+        so the layout is only rebuilt if it is used again.
 
         Parameters
         ----------
@@ -162,15 +182,10 @@ class CuBIDS(object):
         -------
         :obj:`str`
             Path to the CuBIDS code directory.
-
-        Notes
-        -----
-        Why not use ``os.makedirs``?
         """
         # check if BIDS_ROOT/code/CuBIDS exists
         if not self.cubids_code_dir:
-            subprocess.run(["mkdir", self.path + "/code"])
-            subprocess.run(["mkdir", self.path + "/code/CuBIDS/"])
+            os.makedirs(self.path + "/code/CuBIDS", exist_ok=True)
             self.cubids_code_dir = True
         return self.cubids_code_dir
 
@@ -248,64 +263,18 @@ class CuBIDS(object):
             # CHANGE TO SUBPROCESS.CALL IF NOT BLOCKING
             subprocess.run(["datalad", "unlock"], cwd=self.path)
 
-        # loop through all niftis in the bids dir
-        for path in Path(self.path).rglob("sub-*/**/*.*"):
-            # ignore all dot directories
-            if "/." in str(path):
-                continue
-
-            if str(path).endswith(".nii") or str(path).endswith(".nii.gz"):
-                try:
-                    img = nb.load(str(path))
-                except Exception:
-                    print("Empty Nifti File: ", str(path))
-                    continue
+        # collect all niftis in the bids dir, ignoring dot directories
+        nifti_paths = list(_iter_bids_files(self.path, NIFTI_EXTENSIONS))
 
-                # get important info from niftis
-                obliquity = np.any(nb.affines.obliquity(img.affine) > 1e-4)
-                voxel_sizes = img.header.get_zooms()
-                matrix_dims = img.shape
-                # add nifti info to corresponding sidecars​
-                sidecar = img_to_new_ext(str(path), ".json")
-                if Path(sidecar).exists():
-                    try:
-                        with open(sidecar) as f:
-                            data = json.load(f)
-                    except Exception:
-                        print("Error parsing this sidecar: ", sidecar)
-
-                    if "Obliquity" not in data.keys():
-                        data["Obliquity"] = str(obliquity)
-                    if "VoxelSizeDim1" not in data.keys():
-                        data["VoxelSizeDim1"] = float(voxel_sizes[0])
-                    if "VoxelSizeDim2" not in data.keys():
-                        data["VoxelSizeDim2"] = float(voxel_sizes[1])
-                    if "VoxelSizeDim3" not in data.keys():
-                        data["VoxelSizeDim3"] = float(voxel_sizes[2])
-                    if "Dim1Size" not in data.keys():
-                        data["Dim1Size"] = matrix_dims[0]
-                    if "Dim2Size" not in data.keys():
-                        data["Dim2Size"] = matrix_dims[1]
-                    if "Dim3Size" not in data.keys():
-                        data["Dim3Size"] = matrix_dims[2]
-                    if "NumVolumes" not in data.keys():
-                        if img.ndim == 4:
-                            data["NumVolumes"] = matrix_dims[3]
-                        elif img.ndim == 3:
-                            data["NumVolumes"] = 1
-                    if "ImageOrientation" not in data.keys():
-                        orient = nb.orientations.aff2axcodes(img.affine)
-                        joined = "".join(orient) + "+"
-                        data["ImageOrientation"] = joined
-
-                    with open(sidecar, "w") as file:
-                        json.dump(data, file, indent=4)
+        # each nifti only touches its own sidecar, so they can be processed in parallel
+        with ProcessPoolExecutor() as executor:
+            # consume the results so that errors in the workers are raised here
+            list(executor.map(_add_nifti_info_to_sidecar, nifti_paths, chunksize=32))
 
+        # the layout doesn't index metadata, so it is still up to date
         if self.use_datalad:
             self.datalad_save(message="Added nifti info to sidecars")
 
-        self.reset_bids_layout()
-
     def apply_tsv_changes(self, summary_tsv, files_tsv, new_prefix, raise_on_error=True):
         """Apply changes documented in the edited summary tsv and generate the new tsv files.
 
@@ -344,26 +313,31 @@ class CuBIDS(object):
         # Check that the MergeInto column only contains valid merges
         ok_merges, deletions = check_merging_operations(summary_tsv, raise_on_error=raise_on_error)
 
-        merge_commands = []
+        # Row positions of each param group's files, keyed by (ParamGroup, EntitySet)
+        group_rows = files_df.groupby(["ParamGroup", "EntitySet"]).indices
+        no_rows = np.array([], dtype=int)
+
+        merges = []
         for source_id, dest_id in ok_merges:
-            dest_files = files_df.loc[(files_df[["ParamGroup", "EntitySet"]] == dest_id).all(1)]
-            source_files = files_df.loc[
-                (files_df[["ParamGroup", "EntitySet"]] == source_id).all(1)
-            ]
+            dest_files = files_df.iloc[group_rows.get(dest_id, no_rows)]
+            source_files = files_df.iloc[group_rows.get(source_id, no_rows)]
 
             # Get a source json file
             img_full_path = self.path + source_files.iloc[0].FilePath
             source_json = img_to_new_ext(img_full_path, ".json")
+            if not Path(source_json).exists():
+                continue
+
             for dest_nii in dest_files.FilePath:
                 dest_json = img_to_new_ext(self.path + dest_nii, ".json")
-                if Path(dest_json).exists() and Path(source_json).exists():
-                    merge_commands.append(f"bids-sidecar-merge {source_json} {dest_json}")
+                if Path(dest_json).exists():
+                    merges.append((source_json, dest_json))
 
         # Get the delete commands
         # delete_commands = []
         to_remove = []
         for rm_id in deletions:
-            files_to_rm = files_df.loc[(files_df[["ParamGroup", "EntitySet"]] == rm_id).all(1)]
+            files_to_rm = files_df.iloc[group_rows.get(rm_id, no_rows)]
 
             for rm_me in files_to_rm.FilePath:
                 if Path(self.path + rm_me).exists():
@@ -375,83 +349,88 @@ class CuBIDS(object):
 
         # Now do the file renaming
         change_keys_df = summary_df[summary_df.RenameEntitySet.notnull()]
-        move_ops = []
+        moves = {}
         # return if nothing to change
         if len(change_keys_df) > 0:
-            entity_sets = {}
-
-            for i in range(len(change_keys_df)):
-                new_key = change_keys_df.iloc[i]["RenameEntitySet"]
-                old_key_param = change_keys_df.iloc[i]["KeyParamGroup"]
-
-                # add to dictionary
-                entity_sets[old_key_param] = new_key
-
-            # orig key/param tuples that will have new entity set
-            to_change = list(entity_sets.keys())
-
-            for row in range(len(files_df)):
-                file_path = self.path + files_df.loc[row, "FilePath"]
-                if Path(file_path).exists() and "/fmap/" not in file_path:
-                    key_param_group = files_df.loc[row, "KeyParamGroup"]
-
-                    if key_param_group in to_change:
-                        orig_key_param = files_df.loc[row, "KeyParamGroup"]
+            # orig key/param group -> new entity set
+            entity_sets = dict(
+                zip(change_keys_df["KeyParamGroup"], change_keys_df["RenameEntitySet"])
+            )
+            # parse each new entity set once, however many files are renamed to it
+            new_entities = {
+                new_key: _entity_set_to_entities(new_key) for new_key in set(entity_sets.values())
+            }
+
+            # files in the orig key/param groups that will have new entity set,
+            # except for fieldmaps
+            to_change = files_df[
+                files_df["KeyParamGroup"].isin(entity_sets.keys())
+                & ~files_df["FilePath"].str.contains("/fmap/", regex=False, na=False)
+            ]
 
+            # read each fmap json once and write it once, after all the IntendedFor renames
+            self._if_sidecars = {}
+            self._if_sidecars_changed = set()
+            self._if_session_files = {}
+            try:
+                for orig_key_param, file_path in zip(
+                    to_change["KeyParamGroup"], to_change["FilePath"]
+                ):
+                    file_path = self.path + file_path
+                    if Path(file_path).exists():
                         new_key = entity_sets[orig_key_param]
 
-                        new_entities = _entity_set_to_entities(new_key)
-
                         # generate new filenames according to new entity set
-                        self.change_filename(file_path, new_entities)
-
-            # create string of mv command ; mv command for dlapi.run
+                        # (a copy, since change_filename may zero-pad the run)
+                        self.change_filename(file_path, dict(new_entities[new_key]))
+
+                for filename_with_if in sorted(self._if_sidecars_changed):
+                    _update_json(filename_with_if, self._if_sidecars[filename_with_if])
+            finally:
+                # stop batching, so later change_filename calls write IntendedFor directly
+                self._if_sidecars = None
+                self._if_sidecars_changed = set()
+                self._if_session_files = {}
+
+            # the first rename of a file wins, as it would with sequential mv commands
             for from_file, to_file in zip(self.old_filenames, self.new_filenames):
                 if Path(from_file).exists():
-                    # if using datalad, we want to git mv instead of mv
-                    if self.use_datalad:
-                        move_ops.append(f"git mv {from_file} {to_file}")
-                    else:
-                        move_ops.append(f"mv {from_file} {to_file}")
+                    moves.setdefault(from_file, to_file)
 
-        full_cmd = "\n".join(merge_commands + move_ops)
-        if full_cmd:
+        if not merges and not moves:
+            print("Not running any commands")
+        elif self.use_datalad:
+            # dlapi.run needs a command, so write the merges and (git) moves to a script
+            merge_commands = [f"bids-sidecar-merge {src} {dest}" for src, dest in merges]
+            move_ops = [f"git mv {src} {dest}" for src, dest in moves.items()]
             renames = str(Path(self.path) / (new_prefix + "_full_cmd.sh"))
 
             # write full_cmd to a .sh file
             with open(renames, "w") as fo:
-                fo.write("#!/bin/bash\n")
-                fo.write(full_cmd)
+                fo.write("#!/bin/bash\n" + "\n".join(merge_commands + move_ops))
 
-            if self.use_datalad:
-                # first check if IntendedFor renames need to be saved
-                if not self.is_datalad_clean():
-                    s1 = "Renamed IntendedFor references to "
-                    s2 = "Variant Group scans"
-                    IF_rename_msg = s1 + s2
-                    self.datalad_handle.save(message=IF_rename_msg)
+            # first check if IntendedFor renames need to be saved
+            if not self.is_datalad_clean():
+                s1 = "Renamed IntendedFor references to "
+                s2 = "Variant Group scans"
+                IF_rename_msg = s1 + s2
+                self.datalad_handle.save(message=IF_rename_msg)
 
-                s1 = "Renamed Variant Group scans according to their variant "
-                s2 = "parameters"
+            s1 = "Renamed Variant Group scans according to their variant "
+            s2 = "parameters"
 
-                rename_commit = s1 + s2
+            rename_commit = s1 + s2
 
-                self.datalad_handle.run(cmd=["bash", renames], message=rename_commit)
-            else:
-                subprocess.run(
-                    ["bash", renames],
-                    stdout=subprocess.PIPE,
-                    cwd=str(Path(new_prefix).parent),
-                )
+            self.datalad_handle.run(cmd=["bash", renames], message=rename_commit)
         else:
-            print("Not running any commands")
+            for source_json, dest_json in merges:
+                merge_json_into_json(source_json, dest_json)
+            _apply_moves(moves.items())
 
-        self.reset_bids_layout()
+        # files were renamed, so rebuild the layout the next time it is needed
+        self._layout = None
         self.get_tsvs(new_prefix)
 
-        # remove renames file that gets created under the hood
-        subprocess.run(["rm", "-rf", "renames"])
-
     def change_filename(self, filepath, entities):
         """Apply changes to a filename based on the renamed entity sets.
 
@@ -469,8 +448,8 @@ class CuBIDS(object):
         -----
         This is the function I need to spend the most time on, since it has entities hardcoded.
         """
-        exts = Path(filepath).suffixes
-        old_ext = "".join(exts)
+        old_name = Path(filepath).name
+        old_ext = "".join(Path(old_name).suffixes)
 
         suffix = entities["suffix"]
         entity_file_keys = []
@@ -503,11 +482,10 @@ class CuBIDS(object):
 
         # CHECK TO SEE IF DATATYPE CHANGED
         # datatype may be overridden/changed if the original file is located in the wrong folder.
-        dtypes = ["anat", "func", "perf", "fmap", "dwi"]
-        dtype_orig = ""
-        for dtype in dtypes:
-            if dtype in filepath:
-                dtype_orig = dtype
+        # the datatype is the name of the directory the file is in
+        dtype_orig = Path(filepath).parent.name
+        if dtype_orig not in ("anat", "func", "perf", "fmap", "dwi"):
+            dtype_orig = ""
 
         if "datatype" in entities.keys():
             dtype_new = entities["datatype"]
@@ -524,20 +502,14 @@ class CuBIDS(object):
         self.new_filenames.append(new_path)
 
         # NOW NEED TO RENAME ASSOCIATED FILES
-        # bids_file = self.layout.get_file(filepath)
-        bids_file = filepath
-        # associations = bids_file.get_associations()
-        associations = self.get_nifti_associations(str(bids_file))
+        associations = self.get_nifti_associations(filepath)
         for assoc_path in associations:
-            # assoc_path = assoc.path
             if Path(assoc_path).exists():
-                # print("FILE: ", filepath)
-                # print("ASSOC: ", assoc.path)
                 # ensure assoc not an IntendedFor reference
-                if ".nii" not in str(assoc_path):
+                if ".nii" not in assoc_path:
+                    assoc_ext = "".join(Path(assoc_path).suffixes)
                     self.old_filenames.append(assoc_path)
-                    new_ext_path = img_to_new_ext(new_path, "".join(Path(assoc_path).suffixes))
-                    self.new_filenames.append(new_ext_path)
+                    self.new_filenames.append(img_to_new_ext(new_path, assoc_ext))
 
         # MAKE SURE THESE AREN'T COVERED BY get_associations!!!
         # Update DWI-specific files
@@ -557,28 +529,26 @@ class CuBIDS(object):
 
         # Update func-specific files
         # now rename _events and _physio files!
-        old_suffix = parse_file_entities(filepath)["suffix"]
+        old_suffix = old_name[: -len(old_ext)].rsplit("_", 1)[-1]
         scan_end = "_" + old_suffix + old_ext
+        new_scan_end = "_" + suffix + old_ext
 
         if "_task-" in filepath:
             old_events = filepath.replace(scan_end, "_events.tsv")
             if Path(old_events).exists():
                 self.old_filenames.append(old_events)
-                new_scan_end = "_" + suffix + old_ext
                 new_events = new_path.replace(new_scan_end, "_events.tsv")
                 self.new_filenames.append(new_events)
 
             old_ejson = filepath.replace(scan_end, "_events.json")
             if Path(old_ejson).exists():
                 self.old_filenames.append(old_ejson)
-                new_scan_end = "_" + suffix + old_ext
                 new_ejson = new_path.replace(new_scan_end, "_events.json")
                 self.new_filenames.append(new_ejson)
 
         old_physio = filepath.replace(scan_end, "_physio.tsv.gz")
         if Path(old_physio).exists():
             self.old_filenames.append(old_physio)
-            new_scan_end = "_" + suffix + old_ext
             new_physio = new_path.replace(new_scan_end, "_physio.tsv.gz")
             self.new_filenames.append(new_physio)
 
@@ -587,63 +557,76 @@ class CuBIDS(object):
             old_context = filepath.replace(scan_end, "_aslcontext.tsv")
             if Path(old_context).exists():
                 self.old_filenames.append(old_context)
-                new_scan_end = "_" + suffix + old_ext
                 new_context = new_path.replace(new_scan_end, "_aslcontext.tsv")
                 self.new_filenames.append(new_context)
 
             old_m0scan = filepath.replace(scan_end, "_m0scan.nii.gz")
             if Path(old_m0scan).exists():
                 self.old_filenames.append(old_m0scan)
-                new_scan_end = "_" + suffix + old_ext
                 new_m0scan = new_path.replace(new_scan_end, "_m0scan.nii.gz")
                 self.new_filenames.append(new_m0scan)
 
             old_mjson = filepath.replace(scan_end, "_m0scan.json")
             if Path(old_mjson).exists():
                 self.old_filenames.append(old_mjson)
-                new_scan_end = "_" + suffix + old_ext
                 new_mjson = new_path.replace(new_scan_end, "_m0scan.json")
                 self.new_filenames.append(new_mjson)
 
             old_labeling = filepath.replace(scan_end, "_asllabeling.jpg")
             if Path(old_labeling).exists():
                 self.old_filenames.append(old_labeling)
-                new_scan_end = "_" + suffix + old_ext
                 new_labeling = new_path.replace(new_scan_end, "_asllabeling.jpg")
                 self.new_filenames.append(new_labeling)
 
         # RENAME INTENDED FORS!
+        # the old and new references to this file, in both IntendedFor formats
+        old_relative_path = _get_participant_relative_path(filepath)
+        new_relative_path = _get_participant_relative_path(new_path)
+        old_bidsuri = _get_bidsuri(filepath, self.path)
+        new_bidsuri = _get_bidsuri(new_path, self.path)
+        renamed_refs = {old_relative_path: new_relative_path, old_bidsuri: new_bidsuri}
+
         ses_path = self.path + "/" + sub + "/" + ses
-        files_with_if = []
-        files_with_if += Path(ses_path).rglob("fmap/*.json")
-        files_with_if += Path(ses_path).rglob("perf/*_m0scan.json")
+        batching = self._if_sidecars is not None
+        if batching and ses_path in self._if_session_files:
+            files_with_if = self._if_session_files[ses_path]
+        else:
+            files_with_if = []
+            files_with_if += Path(ses_path).rglob("fmap/*.json")
+            files_with_if += Path(ses_path).rglob("perf/*_m0scan.json")
+            if batching:
+                self._if_session_files[ses_path] = files_with_if
+
         for path_with_if in files_with_if:
             filename_with_if = str(path_with_if)
             self.IF_rename_paths.append(filename_with_if)
-            # json_file = self.layout.get_file(filename_with_if)
-            # data = json_file.get_dict()
-            data = get_sidecar_metadata(filename_with_if)
+            if batching and filename_with_if in self._if_sidecars:
+                data = self._if_sidecars[filename_with_if]
+            else:
+                data = get_sidecar_metadata(filename_with_if)
+                if batching:
+                    self._if_sidecars[filename_with_if] = data
+
             if data == "Erroneous sidecar":
                 print("Error parsing sidecar: ", filename_with_if)
                 continue
 
             if "IntendedFor" in data.keys():
                 # Coerce IntendedFor to a list.
-                data["IntendedFor"] = listify(data["IntendedFor"])
-                for item in data["IntendedFor"]:
-                    if item == _get_participant_relative_path(filepath):
-                        # remove old filename
-                        data["IntendedFor"].remove(item)
-                        # add new filename
-                        data["IntendedFor"].append(_get_participant_relative_path(new_path))
-                    if item == _get_bidsuri(filepath, self.path):
-                        # remove old filename
-                        data["IntendedFor"].remove(item)
-                        # add new filename
-                        data["IntendedFor"].append(_get_bidsuri(new_path, self.path))
+                intended_for = listify(data["IntendedFor"])
+                if not any(item in renamed_refs for item in intended_for):
+                    continue
+
+                # remove old filenames and add the new ones
+                data["IntendedFor"] = [
+                    item for item in intended_for if item not in renamed_refs
+                ] + [renamed_refs[item] for item in intended_for if item in renamed_refs]
 
                 # update the json with the new data dictionary
-                _update_json(filename_with_if, data)
+                if batching:
+                    self._if_sidecars_changed.add(filename_with_if)
+                else:
+                    _update_json(filename_with_if, data)
 
         # save IntendedFor purges so that you can datalad run the
         # remove association file commands on a clean dataset
@@ -712,8 +695,8 @@ class CuBIDS(object):
         for subid in unique_subs:
             source = str(self.path) + "/" + subid
             dest = exemplars_dir + "/" + subid
-            # Copy the content of source to destination
-            copytree(source, dest)
+            # Copy the content of source to destination, as reflinks where possible
+            copytree(source, dest, copy_function=_clone_file)
 
         # Copy the dataset_description.json
         copyfile(
@@ -760,13 +743,9 @@ class CuBIDS(object):
         """
         # truncate all paths to intendedfor reference format
         # sub, ses, modality only (no self.path)
-        if_scans = []
-        for scan in scans:
-            if_scans.append(_get_participant_relative_path(self.path + scan))
+        if_scans = {_get_participant_relative_path(self.path + scan) for scan in scans}
 
         for path in Path(self.path).rglob("sub-*/*/fmap/*.json"):
-            # json_file = self.layout.get_file(str(path))
-            # data = json_file.get_dict()
             data = get_sidecar_metadata(str(path))
             if data == "Erroneous sidecar":
                 print("Error parsing sidecar: ", str(path))
@@ -774,14 +753,13 @@ class CuBIDS(object):
 
             # remove scan references in the IntendedFor
             if "IntendedFor" in data.keys():
-                data["IntendedFor"] = listify(data["IntendedFor"])
-
-                for item in data["IntendedFor"]:
-                    if item in if_scans:
-                        data["IntendedFor"].remove(item)
+                intended_for = listify(data["IntendedFor"])
+                kept = [item for item in intended_for if item not in if_scans]
 
-                # update the json with the new data dictionary
-                _update_json(str(path), data)
+                # update the json with the new data dictionary, if anything was removed
+                if len(kept) != len(intended_for):
+                    data["IntendedFor"] = kept
+                    _update_json(str(path), data)
 
         # save IntendedFor purges so that you can datalad run the
         # remove association file commands on a clean dataset
@@ -791,14 +769,14 @@ class CuBIDS(object):
                 s2 = "requested for removal"
                 message = s1 + s2
                 self.datalad_save(message=message)
-                self.reset_bids_layout()
 
         # NOW WE WANT TO PURGE ALL ASSOCIATIONS
 
         to_remove = []
+        scan_set = set(scans)
 
-        for path in Path(self.path).rglob("sub-*/**/*.nii.gz"):
-            if str(path) in scans:
+        for path in _iter_bids_files(self.path, ".nii.gz"):
+            if str(path) in scan_set:
                 # bids_file = self.layout.get_file(str(path))
                 # associations = bids_file.get_associations()
                 associations = self.get_nifti_associations(str(path))
@@ -826,40 +804,33 @@ class CuBIDS(object):
 
         to_remove += scans
 
-        # create rm commands for all files that need to be purged
-        purge_commands = []
-        for rm_me in to_remove:
-            if Path(rm_me).exists():
-                purge_commands.append("rm " + rm_me)
-
-        # datalad run the file deletions (purges)
-        full_cmd = "\n".join(purge_commands)
-        if full_cmd:
-            # write full_cmd to a .sh file
-            # Open file for writing
-
-            path_prefix = str(Path(self.path).parent)
-
-            with open(path_prefix + "/" + "_full_cmd.sh", "w") as fo:
-                fo.write("#!/bin/bash\n")
-                fo.write(full_cmd)
-
-            if self.scans_txt:
-                cmt = f"Purged scans listed in {self.scans_txt} from dataset"
-            else:
-                cmt = "Purged Parameter Groups marked for removal"
+        # all files that need to be purged, each listed once.
+        # The existence checks run concurrently, since stat calls are slow on network mounts.
+        to_remove = list(dict.fromkeys(to_remove))
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            exists = list(executor.map(os.path.exists, to_remove))
+        to_purge = [rm_me for rm_me, rm_exists in zip(to_remove, exists) if rm_exists]
 
-            purge_file = path_prefix + "/" + "_full_cmd.sh"
+        if to_purge:
             if self.use_datalad:
+                # datalad run the file deletions (purges) from a .sh file
+                path_prefix = str(Path(self.path).parent)
+                purge_file = path_prefix + "/" + "_full_cmd.sh"
+                with open(purge_file, "w") as fo:
+                    fo.write("#!/bin/bash\n" + "\n".join("rm " + rm_me for rm_me in to_purge))
+
+                if self.scans_txt:
+                    cmt = f"Purged scans listed in {self.scans_txt} from dataset"
+                else:
+                    cmt = "Purged Parameter Groups marked for removal"
+
                 self.datalad_handle.run(cmd=["bash", purge_file], message=cmt)
             else:
-                subprocess.run(
-                    ["bash", path_prefix + "/" + "_full_cmd.sh"],
-                    stdout=subprocess.PIPE,
-                    cwd=path_prefix,
-                )
+                for rm_me in to_purge:
+                    os.remove(rm_me)
 
-            self.reset_bids_layout()
+            # files were removed, so rebuild the layout the next time it is needed
+            self._layout = None
 
         else:
             print("Not running any association removals")
@@ -869,37 +840,61 @@ class CuBIDS(object):
 
         This uses globbing to find files with the same path, entities, and suffix as the NIfTI,
         but with a different extension.
+        Since the filename encodes the subject, session, and datatype,
+        only the NIfTI's own directory is searched.
         """
         # get all assocation files of a nifti image
         no_ext_file = str(nifti).split("/")[-1].split(".")[0]
         associations = []
-        for path in Path(self.path).rglob(f"sub-*/**/{no_ext_file}.*"):
+        for path in Path(nifti).parent.glob(f"{no_ext_file}.*"):
             if ".nii.gz" not in str(path):
                 associations.append(str(path))
 
         return associations
 
     def _cache_fieldmaps(self):
-        """Search all fieldmaps and create a lookup for each file."""
-        suffix = "(phase1|phasediff|epi|fieldmap)"
-        fmap_files = self.layout.get(
-            suffix=suffix, regex_search=True, extension=[".nii.gz", ".nii"]
+        """Search all fieldmaps and create a lookup for each file.
+
+        The lookup maps the path of each file to the paths of the fieldmaps intended for it.
+        The entity set of each of those fieldmaps is stored alongside it,
+        so it is parsed once rather than once for every file the fieldmap is intended for.
+
+        Returns
+        -------
+        misfits : :obj:`list` of :obj:`str`
+            Paths to fieldmaps that have no IntendedFor field.
+        """
+        suffix = re.compile("(phase1|phasediff|epi|fieldmap)")
+
+        # find the fieldmaps by their suffix while walking the subject directories,
+        # rather than indexing the whole dataset with pybids
+        fmap_files = sorted(
+            path
+            for path in _iter_bids_files(self.path, NIFTI_EXTENSIONS)
+            if suffix.search(os.path.basename(path).split(".")[0].rsplit("_", 1)[-1])
+        )
+
+        # read all the fieldmap sidecars concurrently
+        sidecars = get_sidecars_bulk(
+            [img_to_new_ext(fmap_file, ".json") for fmap_file in fmap_files]
         )
 
         misfits = []
         files_to_fmaps = defaultdict(list)
+        fmap_entity_sets = {}
         for fmap_file in tqdm(fmap_files):
-            # intentions = listify(fmap_file.get_metadata().get("IntendedFor"))
-            fmap_json = img_to_new_ext(fmap_file.path, ".json")
-            metadata = get_sidecar_metadata(fmap_json)
+            fmap_json = img_to_new_ext(fmap_file, ".json")
+            metadata = sidecars[fmap_json]
             if metadata == "Erroneous sidecar":
                 print("Error parsing sidecar: ", str(fmap_json))
                 continue
             if_list = metadata.get("IntendedFor")
             intentions = listify(if_list)
-            subject_prefix = f"sub-{fmap_file.entities['subject']}"
+            # _iter_bids_files paths start with the dataset root, then the subject directory
+            subject_prefix = fmap_file[len(self.path) + 1 :].split(os.sep, 1)[0]
 
             if intentions is not None:
+                fmap_entity_sets[fmap_file] = _file_to_entity_set(fmap_file)
                 for intended_for in intentions:
                     full_path = Path(self.path) / subject_prefix / intended_for
                     files_to_fmaps[str(full_path)].append(fmap_file)
@@ -909,19 +904,24 @@ class CuBIDS(object):
                 misfits.append(fmap_file)
 
         self.fieldmap_lookup = files_to_fmaps
+        self.fieldmap_entity_sets = fmap_entity_sets
         self.fieldmaps_cached = True
 
         # return a list of all filenames where fmap file detected,
         # no intended for found
         return misfits
 
-    def get_param_groups_from_entity_set(self, entity_set):
+    def get_param_groups_from_entity_set(self, entity_set, sidecars=None):
         """Split entity sets into param groups based on json metadata.
 
         Parameters
         ----------
         entity_set : str
             Entity set name.
+        sidecars : :obj:`dict` or None, optional
+            Already-read sidecar metadata, as returned by :func:`get_sidecars_bulk`,
+            covering the entity set's files.
+            If None (the default), the sidecars are read here.
 
         Returns
         -------
@@ -929,33 +929,23 @@ class CuBIDS(object):
             1. A data frame with one row per file where the ParamGroup
             column indicates the group to which each scan belongs.
             2. A data frame with param group summaries
+
+        Notes
+        -----
+        The files for each entity set are taken from ``keys_files``,
+        so :meth:`get_entity_sets` must be run first.
         """
         if not self.fieldmaps_cached:
             raise Exception("Fieldmaps must be cached to find parameter groups.")
-        key_entities = _entity_set_to_entities(entity_set)
-        key_entities["extension"] = ".nii[.gz]*"
-
-        matching_files = self.layout.get(
-            return_type="file", scope="self", regex_search=True, **key_entities
-        )
 
-        # ensure files who's entities contain key_entities but include other
-        # entities do not also get added to matching_files
-        to_include = []
-        for filepath in matching_files:
-            f_entity_set = _file_to_entity_set(filepath)
-
-            if f_entity_set == entity_set:
-                to_include.append(filepath)
+        # get_entity_sets already bucketed every NIfTI by its exact entity set,
+        # so there is no need to query (and re-filter) the layout here
+        to_include = sorted(str(path) for path in self.keys_files.get(entity_set, []))
 
         # get the modality associated with the entity set
-        modalities = ["/dwi/", "/anat/", "/func/", "/perf/", "/fmap/"]
-        modality = ""
-        for mod in modalities:
-            if mod in filepath:
-                modality = mod.replace("/", "").replace("/", "")
-
-        if modality == "":
+        # from the datatype directory the files live in
+        modality = Path(to_include[0]).parent.name if to_include else ""
+        if modality not in MODALITIES:
             print("Unusual Modality Detected")
             modality = "other"
 
@@ -966,6 +956,8 @@ class CuBIDS(object):
             self.grouping_config,
             modality,
             self.keys_files,
+            sidecars=sidecars,
+            fieldmap_entity_sets=self.fieldmap_entity_sets,
         )
 
         if ret == "erroneous sidecar found":
@@ -1080,9 +1072,11 @@ class CuBIDS(object):
     def get_param_groups_dataframes(self):
         """Create DataFrames of files x param groups and a summary."""
         entity_sets = self.get_entity_sets()
+
         labeled_files = []
         param_group_summaries = []
         for entity_set in entity_sets:
+            # each entity set reads its own sidecars, so only one set's metadata is held at once
             try:
                 (
                     labeled_file_params,
@@ -1099,25 +1093,20 @@ class CuBIDS(object):
         big_df = _order_columns(pd.concat(labeled_files, ignore_index=True))
 
         # make Filepaths relative to bids dir
-        for row in range(len(big_df)):
-            long_name = big_df.loc[row, "FilePath"]
-            big_df.loc[row, "FilePath"] = long_name.replace(self.path, "")
+        big_df["FilePath"] = big_df["FilePath"].str.replace(self.path, "", regex=False)
 
         summary = _order_columns(pd.concat(param_group_summaries, ignore_index=True))
 
-        # create new col that strings key and param group together
-        summary["KeyParamGroup"] = summary["EntitySet"] + "__" + summary["ParamGroup"].map(str)
-
-        # move this column to the front of the dataframe
-        key_param_col = summary.pop("KeyParamGroup")
-        summary.insert(0, "KeyParamGroup", key_param_col)
+        # create new col that strings key and param group together,
+        # at the front of the dataframe
+        summary.insert(
+            0, "KeyParamGroup", summary["EntitySet"] + "__" + summary["ParamGroup"].astype(str)
+        )
 
         # do the same for the files df
-        big_df["KeyParamGroup"] = big_df["EntitySet"] + "__" + big_df["ParamGroup"].map(str)
-
-        # move this column to the front of the dataframe
-        key_param_col = big_df.pop("KeyParamGroup")
-        big_df.insert(0, "KeyParamGroup", key_param_col)
+        big_df.insert(
+            0, "KeyParamGroup", big_df["EntitySet"] + "__" + big_df["ParamGroup"].astype(str)
+        )
 
         summary.insert(0, "RenameEntitySet", np.nan)
         summary.insert(0, "MergeInto", np.nan)
@@ -1128,21 +1117,17 @@ class CuBIDS(object):
         # loop though imaging and derived param keys
 
         sidecar = self.grouping_config.get("sidecar_params")
-        sidecar = sidecar[modality]
+        derived = self.grouping_config.get("derived_params")
+        sidecar = {**sidecar[modality], **derived[modality]}
 
         relational = self.grouping_config.get("relational_params")
 
         # list of columns names that we account for in suggested renaming
-        summary["RenameEntitySet"] = summary["RenameEntitySet"].apply(str)
-
-        rename_cols = []
-        tolerance_cols = []
-        for col in sidecar.keys():
-            if "suggest_variant_rename" in sidecar[col].keys():
-                if sidecar[col]["suggest_variant_rename"] and col in summary.columns:
-                    rename_cols.append(col)
-                    if "tolerance" in sidecar[col].keys():
-                        tolerance_cols.append(col)
+        rename_cols = [
+            col
+            for col, col_config in sidecar.items()
+            if col_config.get("suggest_variant_rename") and col in summary.columns
+        ]
 
         # deal with Fmap!
         if "FieldmapKey" in relational:
@@ -1155,86 +1140,74 @@ class CuBIDS(object):
         # deal with IntendedFor Key!
         if "IntendedForKey" in relational:
             if "suggest_variant_rename" in relational["IntendedForKey"].keys():
-                if relational["FieldmapKey"]["suggest_variant_rename"]:
+                if relational["IntendedForKey"]["suggest_variant_rename"]:
                     # check if 'bool' or 'columns'
                     if relational["IntendedForKey"]["display_mode"] == "bool":
                         rename_cols.append("UsedAsFieldmap")
 
-        dom_dict = {}
-        # loop through summary tsv and create dom_dict
-        for row in range(len(summary)):
-            # if 'NumVolumes' in summary.columns \
-            #         and str(summary.loc[row, "NumVolumes"]) == 'nan':
-            #     summary.at[row, "NumVolumes"] = 1.0
-
-            # if dominant group identified
-            if str(summary.loc[row, "ParamGroup"]) == "1":
-                val = {}
-                # grab col, all vals send to dict
-                key = summary.loc[row, "EntitySet"]
-                for col in rename_cols:
-                    summary[col] = summary[col].apply(str)
-                    val[col] = summary.loc[row, col]
-                dom_dict[key] = val
+        # compare the rename columns as strings
+        for col in rename_cols:
+            summary[col] = summary[col].astype(str)
+
+        # the dominant (first) param group's values for each entity set
+        dom_rows = summary[summary["ParamGroup"].astype(str) == "1"]
+        dom_dict = {
+            key: dict(zip(rename_cols, vals))
+            for key, vals in zip(dom_rows["EntitySet"], dom_rows[rename_cols].to_numpy())
+        }
 
         # now loop through again and ID variance
-        for row in range(len(summary)):
-            # check to see if renaming has already happened
-            renamed = False
-            entities = _entity_set_to_entities(summary.loc[row, "EntitySet"])
-            if "VARIANT" in summary.loc[row, "EntitySet"]:
-                renamed = True
-
-            # if NumVolumes is nan, set to 1.0
-            # if 'NumVolumes' in summary.columns \
-            #         and str(summary.loc[row, "NumVolumes"]) == 'nan':
-            #     summary.at[row, "NumVolumes"] = 1.0
-
-            if summary.loc[row, "ParamGroup"] != 1 and not renamed:
-                acq_str = "VARIANT"
-                # now we know we have a deviant param group
-                # check if TR is same as param group 1
-                key = summary.loc[row, "EntitySet"]
-                for col in rename_cols:
-                    summary[col] = summary[col].apply(str)
-                    if summary.loc[row, col] != dom_dict[key][col]:
-                        if col == "HasFieldmap":
-                            if dom_dict[key][col] == "True":
-                                acq_str = acq_str + "NoFmap"
-                            else:
-                                acq_str = acq_str + "HasFmap"
-                        elif col == "UsedAsFieldmap":
-                            if dom_dict[key][col] == "True":
-                                acq_str = acq_str + "Unused"
-                            else:
-                                acq_str = acq_str + "IsUsed"
+        new_names = []
+        for entity_set, param_group, vals in zip(
+            summary["EntitySet"], summary["ParamGroup"], summary[rename_cols].to_numpy()
+        ):
+            # skip dominant groups, and entity sets that have already been renamed
+            if param_group == 1 or "VARIANT" in entity_set:
+                new_names.append("")
+                continue
+
+            acq_str = "VARIANT"
+            # now we know we have a deviant param group
+            # check if TR is same as param group 1
+            dom_vals = dom_dict[entity_set]
+            for col, val in zip(rename_cols, vals):
+                if val != dom_vals[col]:
+                    if col == "HasFieldmap":
+                        if dom_vals[col] == "True":
+                            acq_str = acq_str + "NoFmap"
                         else:
-                            acq_str = acq_str + col
+                            acq_str = acq_str + "HasFmap"
+                    elif col == "UsedAsFieldmap":
+                        if dom_vals[col] == "True":
+                            acq_str = acq_str + "Unused"
+                        else:
+                            acq_str = acq_str + "IsUsed"
+                    else:
+                        acq_str = acq_str + col
 
-                if acq_str == "VARIANT":
-                    acq_str = acq_str + "Other"
+            if acq_str == "VARIANT":
+                acq_str = acq_str + "Other"
 
-                if "acquisition" in entities.keys():
-                    acq = f"acquisition-{entities['acquisition'] + acq_str}"
+            entities = _entity_set_to_entities(entity_set)
+            if "acquisition" in entities.keys():
+                acq = f"acquisition-{entities['acquisition'] + acq_str}"
 
-                    new_name = summary.loc[row, "EntitySet"].replace(
-                        f"acquisition-{entities['acquisition']}",
-                        acq,
-                    )
-                else:
-                    acq = f"acquisition-{acq_str}"
-                    new_name = acq + "_" + summary.loc[row, "EntitySet"]
+                new_name = entity_set.replace(
+                    f"acquisition-{entities['acquisition']}",
+                    acq,
+                )
+            else:
+                acq = f"acquisition-{acq_str}"
+                new_name = acq + "_" + entity_set
 
-                summary.at[row, "RenameEntitySet"] = new_name
+            new_names.append(new_name)
 
-            # convert all "nan" to empty str
-            # so they don't show up in the summary tsv
-            if summary.loc[row, "RenameEntitySet"] == "nan":
-                summary.at[row, "RenameEntitySet"] = ""
+        summary["RenameEntitySet"] = new_names
 
-            for col in rename_cols:
-                if summary.loc[row, col] == "nan":
-                    summary.at[row, col] = ""
+        # convert all "nan" to empty str
+        # so they don't show up in the summary tsv
+        for col in rename_cols:
+            summary[col] = summary[col].replace("nan", "")
 
         return (big_df, summary)
 
@@ -1262,8 +1235,12 @@ class CuBIDS(object):
 
         big_df, summary = self.get_param_groups_dataframes()
 
-        summary = summary.sort_values(by=["Modality", "EntitySetCount"], ascending=[True, False])
-        big_df = big_df.sort_values(by=["Modality", "EntitySetCount"], ascending=[True, False])
+        summary = summary.sort_values(
+            by=["Modality", "EntitySetCount"], ascending=[True, False], kind="stable"
+        )
+        big_df = big_df.sort_values(
+            by=["Modality", "EntitySetCount"], ascending=[True, False], kind="stable"
+        )
 
         # Create json dictionaries for summary and files tsvs
         self.create_data_dictionary()
@@ -1291,25 +1268,13 @@ class CuBIDS(object):
         # reset self.keys_files
         self.keys_files = {}
 
-        entity_sets = set()
-
-        for path in Path(self.path).rglob("sub-*/**/*.*"):
-            # ignore all dot directories
-            if "/." in str(path):
-                continue
-
-            if str(path).endswith(".nii") or str(path).endswith(".nii.gz"):
-                entity_sets.update((_file_to_entity_set(path),))
+        # ignore all dot directories and anything that isn't a NIfTI
+        for path in _iter_bids_files(self.path, NIFTI_EXTENSIONS):
+            # Fill the dictionary of entity set, list of filenames pairs
+            entity_set = _file_to_entity_set(path)
+            self.keys_files.setdefault(entity_set, []).append(Path(path))
 
-                # Fill the dictionary of entity set, list of filenames pairrs
-                ret = _file_to_entity_set(path)
-
-                if ret not in self.keys_files.keys():
-                    self.keys_files[ret] = []
-
-                self.keys_files[ret].append(path)
-
-        return sorted(entity_sets)
+        return sorted(self.keys_files)
 
     def change_metadata(self, filters, metadata):
         """Change metadata.
@@ -1343,16 +1308,22 @@ class CuBIDS(object):
     def get_all_metadata_fields(self):
         """Return all metadata fields in a bids directory."""
         found_fields = set()
-        for json_file in Path(self.path).rglob("*.json"):
-            if ".git" not in str(json_file):
+        json_files = list(_iter_json_files(self.path))
+        # the files are read concurrently, but parsed (and any problems reported) here
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            contents = executor.map(_read_text_or_error, json_files)
+            for json_file, content in zip(json_files, contents):
                 # add this in case `print-metadata-fields` is run before validate
+                if isinstance(content, Exception):
+                    warnings.warn(f"Unexpected error with file {json_file}: {content}")
+                    continue
+
                 try:
-                    with open(json_file, "r", encoding="utf-8") as jsonr:
-                        content = jsonr.read().strip()
-                        if not content:
-                            print(f"Empty file: {json_file}")
-                            continue
-                        metadata = json.loads(content)
+                    content = content.strip()
+                    if not content:
+                        print(f"Empty file: {json_file}")
+                        continue
+                    metadata = json.loads(content)
                     found_fields.update(metadata.keys())
                 except json.JSONDecodeError as e:
                     warnings.warn(f"Error decoding JSON in {json_file}: {e}")
@@ -1367,23 +1338,11 @@ class CuBIDS(object):
         if not remove_fields:
             return
 
-        for json_file in tqdm(Path(self.path).rglob("*.json")):
-            # Check for offending keys in the json file
-            if ".git" not in str(json_file):
-                with open(json_file, "r") as jsonr:
-                    metadata = json.load(jsonr)
-
-                offending_keys = remove_fields.intersection(metadata.keys())
-                # Quit if there are none in there
-                if not offending_keys:
-                    continue
-
-                # Remove the offending keys
-                for key in offending_keys:
-                    del metadata[key]
-                # Write the cleaned output
-                with open(json_file, "w") as jsonr:
-                    json.dump(metadata, jsonr, indent=4)
+        json_files = list(_iter_json_files(self.path))
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            cleaned = executor.map(_remove_fields_from_sidecar, json_files, repeat(remove_fields))
+            for _ in tqdm(cleaned, total=len(json_files)):
+                pass
 
     # # # # FOR TESTING # # # #
     def get_filenames(self):
@@ -1416,6 +1375,19 @@ def _update_json(json_file, metadata):
         print("INVALID JSON DATA")
 
 
+def _apply_moves(moves):
+    """Rename files in-process, creating destination directories as needed.
+
+    Parameters
+    ----------
+    moves : iterable of :obj:`tuple` of (:obj:`str`, :obj:`str`)
+        Pairs of source and destination paths.
+    """
+    for from_file, to_file in moves:
+        os.makedirs(os.path.dirname(to_file), exist_ok=True)
+        os.replace(from_file, to_file)
+
+
 def _entity_set_to_entities(entity_set):
     """Split a entity_set name into a pybids dictionary of entities."""
     return dict([group.split("-") for group in entity_set.split("_")])
@@ -1455,6 +1427,98 @@ def _get_bidsuri(filename, dataset_root):
     raise ValueError(f"Only local datasets are supported: {filename}")
 
 
+def _read_nifti_header(img_path):
+    """Read a NIfTI file's header without loading the image.
+
+    Only the first 348 bytes are read (and decompressed, for ``.nii.gz`` files).
+    Files that don't have a NIfTI-1 header, such as NIfTI-2 files, are loaded with nibabel.
+
+    Parameters
+    ----------
+    img_path : :obj:`str`
+        Path to the NIfTI file.
+
+    Returns
+    -------
+    header : :obj:`nibabel.nifti1.Nifti1Header` or :obj:`nibabel.nifti2.Nifti2Header`
+        The image's header.
+    """
+    opener = gzip.open if img_path.endswith(".gz") else open
+    with opener(img_path, "rb") as fobj:
+        binaryblock = fobj.read(nb.Nifti1Header.template_dtype.itemsize)
+
+    # sizeof_hdr is 348 for NIfTI-1 headers, in either byte order
+    if binaryblock[:4] not in (b"\x5c\x01\x00\x00", b"\x00\x00\x01\x5c"):
+        return nb.load(img_path).header
+
+    return nb.Nifti1Header(binaryblock, check=True)
+
+
+def _add_nifti_info_to_sidecar(img_path):
+    """Add info from a NIfTI file's header to its JSON sidecar.
+
+    Fields that are already in the sidecar are left as they are.
+
+    Parameters
+    ----------
+    img_path : :obj:`str`
+        Path to the NIfTI file.
+    """
+    try:
+        header = _read_nifti_header(img_path)
+    except Exception:
+        print("Empty Nifti File: ", img_path)
+        return
+
+    sidecar = img_to_new_ext(img_path, ".json")
+    if not Path(sidecar).exists():
+        return
+
+    try:
+        data = _load_json(sidecar)
+    except Exception:
+        print("Error parsing this sidecar: ", sidecar)
+        return
+
+    n_fields = len(data)
+
+    # get important info from niftis
+    affine = header.get_best_affine()
+    obliquity = np.any(nb.affines.obliquity(affine) > 1e-4)
+    voxel_sizes = header.get_zooms()
+    matrix_dims = header.get_data_shape()
+
+    # add nifti info to corresponding sidecars
+    if "Obliquity" not in data.keys():
+        data["Obliquity"] = str(obliquity)
+    if "VoxelSizeDim1" not in data.keys():
+        data["VoxelSizeDim1"] = float(voxel_sizes[0])
+    if "VoxelSizeDim2" not in data.keys():
+        data["VoxelSizeDim2"] = float(voxel_sizes[1])
+    if "VoxelSizeDim3" not in data.keys():
+        data["VoxelSizeDim3"] = float(voxel_sizes[2])
+    if "Dim1Size" not in data.keys():
+        data["Dim1Size"] = matrix_dims[0]
+    if "Dim2Size" not in data.keys():
+        data["Dim2Size"] = matrix_dims[1]
+    if "Dim3Size" not in data.keys():
+        data["Dim3Size"] = matrix_dims[2]
+    if "NumVolumes" not in data.keys():
+        if len(matrix_dims) == 4:
+            data["NumVolumes"] = matrix_dims[3]
+        elif len(matrix_dims) == 3:
+            data["NumVolumes"] = 1
+    if "ImageOrientation" not in data.keys():
+        orient = nb.orientations.aff2axcodes(affine)
+        joined = "".join(orient) + "+"
+        data["ImageOrientation"] = joined
+
+    # sidecars that already have every field (e.g., on reruns) are left untouched
+    if len(data) != n_fields:
+        with open(sidecar, "w") as file:
+            json.dump(data, file, indent=4)
+
+
 def _get_param_groups(
     files,
     fieldmap_lookup,
@@ -1462,6 +1526,8 @@ def _get_param_groups(
     grouping_config,
     modality,
     keys_files,
+    sidecars=None,
+    fieldmap_entity_sets=None,
 ):
     """Find a list of *parameter groups* from a list of files.
 
@@ -1477,6 +1543,13 @@ def _get_param_groups(
         (e.g. "sub-X/ses-Y/func/sub-X_ses-Y_task-rest_bold.nii.gz")
     grouping_config : :obj:`dict`
         configuration for defining parameter groups
+    sidecars : :obj:`dict` or None, optional
+        Already-read sidecar metadata, as returned by :func:`get_sidecars_bulk`.
+        If None (the default), the files' sidecars are read here.
+    fieldmap_entity_sets : :obj:`dict` or None, optional
+        Entity set of each fieldmap in ``fieldmap_lookup``,
+        as stored by :meth:`CuBIDS._cache_fieldmaps`.
+        If None (the default), the fieldmaps' entity sets are parsed here.
 
     Returns
     -------
@@ -1491,24 +1564,28 @@ def _get_param_groups(
         return None, None
 
     # Split the config into separate parts
-    imaging_params = grouping_config.get("sidecar_params", {})
-    imaging_params = imaging_params[modality]
-
     relational_params = grouping_config.get("relational_params", {})
 
     derived_params = grouping_config.get("derived_params")
     derived_params = derived_params[modality]
 
-    imaging_params.update(derived_params)
+    imaging_params = grouping_config.get("sidecar_params", {})
+    imaging_params = {**imaging_params[modality], **derived_params}
 
     dfs = []
     # path needs to be relative to the root with no leading prefix
 
+    if sidecars is None:
+        sidecars = get_sidecars_bulk([img_to_new_ext(path, ".json") for path in files])
+    if fieldmap_entity_sets is None and "FieldmapKey" in relational_params:
+        fieldmap_entity_sets = {
+            fmap: _file_to_entity_set(fmap) for path in files for fmap in fieldmap_lookup[path]
+        }
     for path in files:
-        # metadata = layout.get_metadata(path)
-        metadata = get_sidecar_metadata(img_to_new_ext(path, ".json"))
+        json_file = img_to_new_ext(path, ".json")
+        metadata = sidecars[json_file]
         if metadata == "Erroneous sidecar":
-            print("Error parsing sidecar: ", img_to_new_ext(path, ".json"))
+            print("Error parsing sidecar: ", json_file)
         else:
             intentions = metadata.get("IntendedFor", [])
             slice_times = metadata.get("SliceTiming", [])
@@ -1520,7 +1597,7 @@ def _get_param_groups(
             # Get the fieldmaps out and add their types
             if "FieldmapKey" in relational_params:
                 fieldmap_types = sorted(
-                    [_file_to_entity_set(fmap.path) for fmap in fieldmap_lookup[path]]
+                    [fieldmap_entity_sets[fmap] for fmap in fieldmap_lookup[path]]
                 )
 
                 # check if config says columns or bool
@@ -1559,82 +1636,118 @@ def _get_param_groups(
 
     # Assign each file to a ParamGroup
 
-    # round param groups based on precision
-    df = round_params(pd.DataFrame(dfs), grouping_config, modality)
-
     # cluster param groups based on tolerance
-    df = format_params(df, grouping_config, modality)
-    # param_group_cols = list(set(df.columns.to_list()) - set(["FilePath"]))
-
-    # get the subset of columns to drop duplicates by
-    check_cols = []
-    for col in list(df.columns):
-        if f"Cluster_{col}" not in list(df.columns) and col != "FilePath":
-            check_cols.append(col)
+    df = format_params(pd.DataFrame(dfs), grouping_config, modality)
 
-    # Find the unique ParamGroups and assign ID numbers in "ParamGroup"\
-    try:
-        deduped = df.drop("FilePath", axis=1)
-    except Exception:
+    if "FilePath" not in df:
         return "erroneous sidecar found"
 
-    deduped = deduped.drop_duplicates(subset=check_cols, ignore_index=True)
-    deduped["ParamGroup"] = np.arange(deduped.shape[0]) + 1
+    # get the subset of columns to group files by
+    check_cols = [
+        col for col in df.columns if f"Cluster_{col}" not in df.columns and col != "FilePath"
+    ]
 
-    # add the modality as a column
-    deduped["Modality"] = modality
+    # Find the unique ParamGroups and assign ID numbers in "ParamGroup",
+    # in the order they first appear
+    param_group_ids, counts = _label_param_groups([df[col] for col in check_cols])
+    df["ParamGroup"] = param_group_ids + 1
+    df["Counts"] = counts
 
-    # add entity set count column (will delete later)
-    deduped["EntitySetCount"] = len(keys_files[entity_set_name])
+    # the cluster labels are only needed to find the groups
+    df = df.drop([col for col in df.columns if col.startswith("Cluster_")], axis=1)
 
-    # Add the ParamGroup to the whole list of files
-    labeled_files = pd.merge(df, deduped, on=check_cols)
+    # round the reported values based on precision,
+    # only after grouping so values straddling a rounding boundary are not split
+    df = round_params(df, grouping_config, modality)
 
-    value_counts = labeled_files.ParamGroup.value_counts()
+    # add the modality as a column
+    df["Modality"] = modality
 
-    param_group_counts = pd.DataFrame(
-        {"Counts": value_counts.to_numpy(), "ParamGroup": value_counts.index.to_numpy()}
+    # add entity set count column (will delete later)
+    df["EntitySetCount"] = len(keys_files[entity_set_name])
+
+    # Each param group is summarized by its first file
+    _, first_rows = np.unique(df["ParamGroup"].to_numpy(), return_index=True)
+    param_groups_with_counts = df.iloc[first_rows].reset_index(drop=True)
+    param_groups_with_counts = param_groups_with_counts.drop("FilePath", axis=1)
+
+    # Sort by counts and relabel the param groups,
+    # keeping a lookup from the first-appearance ids to the new ones.
+    # Groups with tied counts stay in order of first appearance.
+    param_groups_with_counts.sort_values(
+        by=["Counts"], inplace=True, ascending=False, kind="stable"
     )
+    n_groups = param_groups_with_counts.shape[0]
+    new_ids = np.empty(n_groups + 1, dtype=int)
+    new_ids[param_groups_with_counts["ParamGroup"].to_numpy()] = np.arange(n_groups) + 1
+    param_groups_with_counts["ParamGroup"] = np.arange(n_groups) + 1
+
+    # Send the new, ordered param group ids to the files list,
+    # along with the values of the group's first file.
+    # Files are ordered by param group, keeping their original order within each group.
+    file_ids = new_ids[df["ParamGroup"].to_numpy()]
+    file_order = np.argsort(file_ids, kind="stable")
+    ordered_labeled_files = param_groups_with_counts.iloc[file_ids[file_order] - 1]
+    ordered_labeled_files = ordered_labeled_files.reset_index(drop=True)
+    ordered_labeled_files["FilePath"] = df["FilePath"].to_numpy()[file_order]
 
-    param_groups_with_counts = pd.merge(deduped, param_group_counts, on=["ParamGroup"])
+    return ordered_labeled_files, param_groups_with_counts
 
-    # Sort by counts and relabel the param groups
-    param_groups_with_counts.sort_values(by=["Counts"], inplace=True, ascending=False)
-    param_groups_with_counts["ParamGroup"] = np.arange(param_groups_with_counts.shape[0]) + 1
 
-    # Send the new, ordered param group ids to the files list
-    ordered_labeled_files = pd.merge(
-        df, param_groups_with_counts, on=check_cols, suffixes=("_x", "")
-    )
+def _label_param_groups(columns):
+    """Label rows by their combination of values across columns.
 
-    # sort ordered_labeled_files by param group
-    ordered_labeled_files.sort_values(by=["Counts"], inplace=True, ascending=False)
+    Parameters
+    ----------
+    columns : :obj:`list` of :obj:`pandas.Series`
+        Equal-length columns to group rows by.
+        Missing values are treated as equal to each other.
 
-    # now get rid of cluster cols from deduped and df
-    for col in list(ordered_labeled_files.columns):
-        if col.startswith("Cluster_"):
-            ordered_labeled_files = ordered_labeled_files.drop(col, axis=1)
-            param_groups_with_counts = param_groups_with_counts.drop(col, axis=1)
-        if col.endswith("_x"):
-            ordered_labeled_files = ordered_labeled_files.drop(col, axis=1)
+    Returns
+    -------
+    labels : :obj:`numpy.ndarray`
+        Zero-based label for each row, numbered in the order the combinations first appear.
+    counts : :obj:`numpy.ndarray`
+        Number of rows sharing each row's label.
 
-    return ordered_labeled_files, param_groups_with_counts
+    Examples
+    --------
+    >>> labels, counts = _label_param_groups(
+    ...     [pd.Series(["j", "j-", "j", "j"]), pd.Series([2.0, 2.0, np.nan, 2.0])]
+    ... )
+    >>> labels
+    array([0, 1, 2, 0])
+    >>> counts
+    array([2, 1, 1, 2])
+    """
+    labels = np.zeros(len(columns[0]), dtype=np.int64)
+    n_labels = 1
+    for column in columns:
+        codes, uniques = pd.factorize(column, use_na_sentinel=False)
+        # Renumber before the combined codes could overflow
+        if n_labels * len(uniques) >= 2**62:
+            labels, label_uniques = pd.factorize(labels)
+            n_labels = len(label_uniques)
+
+        labels = labels * len(uniques) + codes
+        n_labels *= len(uniques)
+
+    labels, _ = pd.factorize(labels)
+    return labels, np.bincount(labels)[labels]
 
 
 def round_params(param_group_df, config, modality):
     """Round columns' values in DataFrame according to requested precision."""
-    to_format = config["sidecar_params"][modality]
-    to_format.update(config["derived_params"][modality])
+    to_format = {**config["sidecar_params"][modality], **config["derived_params"][modality]}
+    precisions = {
+        column_name: column_fmt["precision"]
+        for column_name, column_fmt in to_format.items()
+        if "precision" in column_fmt and column_name in param_group_df
+    }
 
-    for column_name, column_fmt in to_format.items():
-        if column_name not in param_group_df:
-            continue
-
-        if "precision" in column_fmt:
-            if isinstance(param_group_df[column_name], float):
-                param_group_df[column_name] = param_group_df[column_name].round(
-                    column_fmt["precision"]
-                )
+    for column_name, precision in precisions.items():
+        if pd.api.types.is_float_dtype(param_group_df[column_name]):
+            param_group_df[column_name] = param_group_df[column_name].round(precision)
 
     return param_group_df
 
@@ -1645,16 +1758,192 @@ def get_sidecar_metadata(json_file):
     Transform json dictionary to Python dictionary.
     """
     try:
-        with open(json_file) as json_file:
-            data = json.load(json_file)
-            return data
+        return _load_json(json_file)
     except Exception:
         # print("Error loading sidecar: ", json_filename)
         return "Erroneous sidecar"
 
 
+def get_sidecars_bulk(json_files, max_workers=IO_WORKERS):
+    """Get the metadata in many sidecars, reading them concurrently.
+
+    Parameters
+    ----------
+    json_files : :obj:`list` of :obj:`str`
+        Paths to the sidecars.
+    max_workers : :obj:`int`, optional
+        Maximum number of threads used to read the sidecars.
+        Default is ``IO_WORKERS`` (16).
+
+    Returns
+    -------
+    sidecars : :obj:`dict`
+        Dictionary mapping each path in ``json_files``
+        to the output of :func:`get_sidecar_metadata` for it.
+    """
+    json_files = list(dict.fromkeys(json_files))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(json_files, executor.map(get_sidecar_metadata, json_files)))
+
+
+def _read_text_or_error(path):
+    """Read a text file, returning the error instead of raising it.
+
+    This lets files be read in a thread pool while problems are still reported
+    (in order) by the caller.
+
+    Parameters
+    ----------
+    path : :obj:`str`
+        Path to the file.
+
+    Returns
+    -------
+    :obj:`str` or :obj:`Exception`
+        The file's contents, or the exception raised while reading it.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as fobj:
+            return fobj.read()
+    except Exception as e:
+        return e
+
+
+def _remove_fields_from_sidecar(json_file, remove_fields):
+    """Remove fields from a sidecar, rewriting it only if any of them were present.
+
+    Parameters
+    ----------
+    json_file : :obj:`str`
+        Path to the sidecar.
+    remove_fields : :obj:`set` of :obj:`str`
+        Fields to remove.
+    """
+    # Check for offending keys in the json file
+    metadata = _load_json(json_file)
+
+    offending_keys = metadata.keys() & remove_fields
+    # Quit if there are none in there
+    if not offending_keys:
+        return
+
+    # Remove the offending keys
+    for key in offending_keys:
+        del metadata[key]
+    # Write the cleaned output
+    with open(json_file, "w") as jsonr:
+        json.dump(metadata, jsonr, indent=4)
+
+
+def _complete_linkage_1d(values, distance_threshold):
+    """Cluster a 1-D array with complete linkage, stopping at a distance threshold.
+
+    This gives the same partition as
+    ``AgglomerativeClustering(n_clusters=None, distance_threshold=distance_threshold,
+    linkage="complete")`` fit on ``values.reshape(-1, 1)``, up to tie-breaking between
+    equal merge distances, without building a distance matrix.
+
+    Parameters
+    ----------
+    values : :obj:`numpy.ndarray`
+        1-D array of finite values to cluster.
+    distance_threshold : :obj:`float`
+        Clusters are only merged if the distance between their
+        furthest members is below this value.
+
+    Returns
+    -------
+    labels : :obj:`numpy.ndarray`
+        Integer cluster label for each element of ``values``.
+        Labels are numbered in ascending order of value.
+
+    Notes
+    -----
+    In one dimension, the complete-linkage distance between two clusters is the span
+    of their union, so the closest pair of clusters is always a pair of neighbors in
+    sorted order. Each merge therefore only needs to update the spans to the merged
+    cluster's two neighbors, which are kept in a heap.
+    Most columns hold a handful of distinct values that are either identical or
+    far apart, so the heap is skipped when no merge between distinct values is possible.
+
+    Examples
+    --------
+    >>> _complete_linkage_1d(np.array([1.0, 1.0012, 1.0004, 2.0]), 0.001)
+    array([0, 1, 0, 2])
+    """
+    if distance_threshold <= 0:
+        # Nothing is close enough to merge, not even identical values
+        labels = np.empty(values.shape[0], dtype=int)
+        labels[np.argsort(values, kind="stable")] = np.arange(values.shape[0])
+        return labels
+
+    # The common case: every value is within tolerance of every other,
+    # which is checked without sorting
+    if values.shape[0] == 0 or values.max() - values.min() < distance_threshold:
+        return np.zeros(values.shape[0], dtype=int)
+
+    # Identical values are always merged first, so cluster the unique values
+    # and map the labels back
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    n_values = unique_values.shape[0]
+
+    gaps = np.diff(unique_values)
+    if gaps.min() >= distance_threshold:
+        return inverse
+
+    # Clusters are runs of unique_values, identified by the index they start at
+    stops = list(range(1, n_values + 1))
+    prevs = list(range(-1, n_values - 1))
+    alive = [True] * n_values
+
+    # Heap entries are (span, left start, right start, right stop)
+    heap = [(gap, i, i + 1, i + 2) for i, gap in enumerate(gaps.tolist())]
+    heapq.heapify(heap)
+    while heap:
+        span, left, right, right_stop = heapq.heappop(heap)
+        if span >= distance_threshold:
+            break
+
+        # Skip pairs that have been invalidated by an earlier merge
+        if not (alive[left] and alive[right]):
+            continue
+        if stops[left] != right or stops[right] != right_stop:
+            continue
+
+        # The left cluster absorbs the right one
+        stops[left] = right_stop
+        alive[right] = False
+        prev = prevs[left]
+        if prev >= 0:
+            heapq.heappush(
+                heap, (unique_values[right_stop - 1] - unique_values[prev], prev, left, right_stop)
+            )
+
+        if right_stop < n_values:
+            prevs[right_stop] = left
+            next_stop = stops[right_stop]
+            heapq.heappush(
+                heap,
+                (
+                    unique_values[next_stop - 1] - unique_values[left],
+                    left,
+                    right_stop,
+                    next_stop,
+                ),
+            )
+
+    unique_labels = np.empty(n_values, dtype=int)
+    start = label = 0
+    while start < n_values:
+        unique_labels[start : stops[start]] = label
+        start = stops[start]
+        label += 1
+
+    return unique_labels[inverse]
+
+
 def format_params(param_group_df, config, modality):
-    """Run AgglomerativeClustering on param groups and add columns to dataframe.
+    """Cluster param groups' values within tolerance and add columns to dataframe.
 
     Parameters
     ----------
@@ -1692,31 +1981,27 @@ def format_params(param_group_df, config, modality):
     The modality-wise dictionary's keys are names of BIDS fields to derive from the
     NIfTI header and include in the Parameter Groupings.
     """
-    to_format = config["sidecar_params"][modality]
-    to_format.update(config["derived_params"][modality])
-
-    for column_name, column_fmt in to_format.items():
-        if column_name not in param_group_df:
-            continue
-
-        if "tolerance" in column_fmt and len(param_group_df) > 1:
-            array = param_group_df[column_name].to_numpy().reshape(-1, 1)
+    if len(param_group_df) <= 1:
+        return param_group_df
 
-            for i in range(len(array)):
-                if np.isnan(array[i, 0]):
-                    array[i, 0] = -999
+    to_format = {**config["sidecar_params"][modality], **config["derived_params"][modality]}
+    tolerances = {
+        column_name: column_fmt["tolerance"]
+        for column_name, column_fmt in to_format.items()
+        if "tolerance" in column_fmt and column_name in param_group_df
+    }
 
-            tolerance = to_format[column_name]["tolerance"]
-            clustering = AgglomerativeClustering(
-                n_clusters=None, distance_threshold=tolerance, linkage="complete"
-            ).fit(array)
+    for column_name, tolerance in tolerances.items():
+        # float columns are clustered without a copy, unless missing values need filling
+        array = param_group_df[column_name].to_numpy(dtype=float)
+        nan_mask = np.isnan(array)
+        if nan_mask.any():
+            array = np.where(nan_mask, -999, array)
 
-            for i in range(len(array)):
-                if array[i, 0] == -999:
-                    array[i, 0] = np.nan
+        labels = _complete_linkage_1d(array, tolerance)
 
-            # now add clustering_labels as a column
-            param_group_df[f"Cluster_{column_name}"] = clustering.labels_
+        # now add clustering_labels as a column
+        param_group_df[f"Cluster_{column_name}"] = labels
 
     return param_group_df
 
@@ -1733,14 +2018,12 @@ def _order_columns(df):
     and the strings in that constant are hardcoded here,
     so we might not need that constant at all.
     """
-    cols = set(df.columns.to_list())
+    cols = set(df.columns)
     non_id_cols = cols - ID_VARS
     new_columns = ["EntitySet", "ParamGroup"] + sorted(non_id_cols)
     if "FilePath" in cols:
         new_columns.append("FilePath")
 
-    df = df[new_columns]
-
     return df[new_columns]
 
 
@@ -1758,13 +2041,17 @@ def img_to_new_ext(img_path, new_ext):
         return img_path.rpartition("_")[0] + "_events" + new_ext
     elif new_ext == ".tsv.gz":
         return img_path.rpartition("_")[0] + "_physio" + new_ext
+    elif img_path.endswith(".nii.gz"):
+        return img_path[:-7] + new_ext
+    elif img_path.endswith(".nii"):
+        return img_path[:-4] + new_ext
     else:
-        return img_path.replace(".nii.gz", "").replace(".nii", "") + new_ext
+        return img_path + new_ext
 
 
 def get_key_name(path, key):
     """Given a filepath and BIDS key name, return value."""
-    parts = Path(path).parts
-    for part in parts:
-        if part.startswith(key + "-"):
+    prefix = key + "-"
+    for part in str(path).split("/"):
+        if part.startswith(prefix):
             return part
@@ -1,9 +1,10 @@
 """Tools for merging metadata."""
 
 import json
+import os
 from collections import defaultdict
-from copy import deepcopy
-from math import isnan, nan
+from functools import lru_cache
+from math import nan
 
 import numpy as np
 import pandas as pd
@@ -36,6 +37,8 @@ def check_merging_operations(action_tsv, raise_on_error=False):
         If there are errors and ``raise_on_error`` is ``True``.
     """
     actions = pd.read_table(action_tsv)
+    # MergeInto is read as object when a hand-edited TSV has stray text in it
+    actions["MergeInto"] = pd.to_numeric(actions["MergeInto"], errors="coerce")
     ok_merges = []
     deletions = []
     overwrite_merges = []
@@ -52,22 +55,28 @@ def check_merging_operations(action_tsv, raise_on_error=False):
     def _check_sdc_cols(meta1, meta2):
         return {key: meta1[key] for key in sdc_cols} == {key: meta2[key] for key in sdc_cols}
 
-    needs_merge = actions[np.isfinite(actions["MergeInto"])]
-    for _, row_needs_merge in needs_merge.iterrows():
-        source_param_key = tuple(row_needs_merge[["MergeInto", "EntitySet"]])
-        dest_param_key = tuple(row_needs_merge[["ParamGroup", "EntitySet"]])
-        dest_metadata = row_needs_merge.to_dict()
-        source_row = actions.loc[(actions[["ParamGroup", "EntitySet"]] == source_param_key).all(1)]
+    # Index every row by (ParamGroup, EntitySet) once; ambiguous keys map to None
+    source_rows = {}
+    for row in actions.to_dict("records"):
+        param_key = (row["ParamGroup"], row["EntitySet"])
+        source_rows[param_key] = None if param_key in source_rows else row
+
+    needs_merge = actions[np.isfinite(actions["MergeInto"].to_numpy(dtype=float))]
+    columns = list(actions.columns)
+    for values in needs_merge.itertuples(index=False, name=None):
+        dest_metadata = dict(zip(columns, values))
+        source_param_key = (dest_metadata["MergeInto"], dest_metadata["EntitySet"])
+        dest_param_key = (dest_metadata["ParamGroup"], dest_metadata["EntitySet"])
 
         if source_param_key[0] == 0:
             print("going to delete ", dest_param_key)
             deletions.append(dest_param_key)
             continue
 
-        if not source_row.shape[0] == 1:
+        source_metadata = source_rows.get(source_param_key)
+        if source_metadata is None:
             raise Exception("Could not identify a unique source group")
 
-        source_metadata = source_row.iloc[0].to_dict()
         merge_id = (source_param_key, dest_param_key)
         # Check for compatible fieldmaps
         if not _check_sdc_cols(source_metadata, dest_metadata):
@@ -142,8 +151,8 @@ def merge_without_overwrite(source_meta, dest_meta_orig, raise_on_error=False):
     :obj:`Exception`
         If there are errors and ``raise_on_error`` is ``True``.
     """
-    # copy the original json params
-    dest_meta = deepcopy(dest_meta_orig)
+    # only top-level keys are reassigned, so a shallow copy is enough
+    dest_meta = dest_meta_orig.copy()
 
     if not source_meta.get("NSliceTimes") == dest_meta.get("NSliceTimes"):
         if raise_on_error:
@@ -154,38 +163,32 @@ def merge_without_overwrite(source_meta, dest_meta_orig, raise_on_error=False):
             )
         return {}
 
-    for parameter in DIRECT_IMAGING_PARAMS:
-        source_value = source_meta.get(parameter, nan)
-        dest_value = dest_meta.get(parameter, nan)
+    # parameters missing or NaN in the source have nothing to contribute
+    for parameter in DIRECT_IMAGING_PARAMS.intersection(source_meta):
+        source_value = source_meta[parameter]
+        # NaN is the only value that compares unequal to itself
+        if source_value != source_value:
+            continue
 
         # cannot merge num --> num
         # exception should only be raised
         # IF someone tries to replace a num (dest)
         # with a num (src)
-        if not is_nan(source_value):
-            # need to figure out if we can merge
-            if not is_nan(dest_value) and source_value != dest_value:
-                if raise_on_error:
-                    raise Exception(
-                        f"Value for {parameter} is {dest_value} in destination "
-                        f"but {source_value} in source"
-                    )
+        dest_value = dest_meta.get(parameter, nan)
+        if dest_value == dest_value and source_value != dest_value:
+            if raise_on_error:
+                raise Exception(
+                    f"Value for {parameter} is {dest_value} in destination "
+                    f"but {source_value} in source"
+                )
 
-                return {}
+            return {}
 
         dest_meta[parameter] = source_value
 
     return dest_meta
 
 
-def is_nan(val):
-    """Return True if val is NaN."""
-    if not isinstance(val, float):
-        return False
-
-    return isnan(val)
-
-
 def print_merges(merge_list):
     """Print formatted text of merges."""
     merge_strings = []
@@ -223,7 +226,6 @@ def merge_json_into_json(from_file, to_file, raise_on_error=False):
 
     with open(to_file, "r") as tof:
         dest_metadata = json.load(tof)
-    orig_dest_metadata = deepcopy(dest_metadata)
 
     merged_metadata = merge_without_overwrite(
         source_metadata,
@@ -235,7 +237,7 @@ def merge_json_into_json(from_file, to_file, raise_on_error=False):
         return 255
 
     # Only write if the data has changed
-    if not merged_metadata == orig_dest_metadata:
+    if not merged_metadata == dest_metadata:
         print("OVERWRITING", to_file)
         with open(to_file, "w") as tofw:
             json.dump(merged_metadata, tofw, indent=4)
@@ -293,23 +295,31 @@ def group_by_acquisition_sets(files_tsv, output_prefix, acq_group_level):
     files_df = pd.read_table(
         files_tsv,
     )
-    acq_groups = defaultdict(list)
-    for _, row in files_df.iterrows():
-        file_entities = parse_file_entities(row.FilePath)
-
-        if acq_group_level == "subject":
-            acq_id = (file_entities.get("subject"), file_entities.get("session"))
-            acq_groups[acq_id].append((row.EntitySet, row.ParamGroup))
-        else:
-            acq_id = (file_entities.get("subject"), None)
-            acq_groups[acq_id].append(
-                (row.EntitySet, row.ParamGroup, file_entities.get("session"))
-            )
+
+    # subject and session come from the directory, so parse each one only once
+    @lru_cache(maxsize=None)
+    def _parse_parent(dirpath):
+        return parse_file_entities(os.path.join(dirpath, "dummy"))
+
+    entities = [_parse_parent(os.path.dirname(path)) for path in files_df["FilePath"]]
+    files_df["_subject"] = [file_entities.get("subject") for file_entities in entities]
+    sessions = [file_entities.get("session") for file_entities in entities]
+    if acq_group_level == "subject":
+        files_df["_session"] = sessions
+        files_df["_contents"] = list(zip(files_df["EntitySet"], files_df["ParamGroup"]))
+    else:
+        files_df["_session"] = None
+        files_df["_contents"] = list(zip(files_df["EntitySet"], files_df["ParamGroup"], sessions))
+
+    # Collect the sorted contents of each subject/session in order of appearance
+    acq_groups = files_df.groupby(["_subject", "_session"], sort=False, dropna=False)[
+        "_contents"
+    ].agg(lambda contents: tuple(sorted(contents)))
 
     # Map the contents to a list of subjects/sessions
     contents_to_subjects = defaultdict(list)
-    for key, value in acq_groups.items():
-        contents_to_subjects[tuple(sorted(value))].append(key)
+    for (subject, session), content_id in acq_groups.items():
+        contents_to_subjects[content_id].append((subject, None if pd.isna(session) else session))
 
     # Sort them based on how many have that group
     content_ids = []
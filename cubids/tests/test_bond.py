@@ -11,7 +11,9 @@ import pandas as pd
 import pytest
 from packaging.version import Version
 
-from cubids.cubids import CuBIDS
+from cubids.constants import NON_KEY_ENTITIES
+from cubids.config import load_config
+from cubids.cubids import CuBIDS, _get_param_groups, format_params, round_params
 from cubids.metadata_merge import merge_json_into_json, merge_without_overwrite
 from cubids.tests.utils import (
     _add_deletion,
@@ -23,6 +25,7 @@ from cubids.tests.utils import (
     file_hash,
     get_data,
 )
+from cubids.utils import _clone_file, _load_json
 from cubids.validator import (
     build_validator_call,
     parse_validator_output,
@@ -589,6 +592,8 @@ def test_merge_without_overwrite():
     meta_NaN["FlipAngle"] = np.nan
     valid_merge = merge_without_overwrite(meta_NaN, meta1)
     assert valid_merge
+    # a NaN in the source must not clobber the destination value
+    assert valid_merge["FlipAngle"] == meta1["FlipAngle"]
 
     # Set a conflicting imaging param in the dest group
     meta_overwrite = deepcopy(meta1)
@@ -611,6 +616,81 @@ def test_merge_without_overwrite():
     assert not bad_slice_merge
 
 
+def test_load_json(tmp_path):
+    """Test that _load_json reads sidecars that only the standard library accepts."""
+    sidecar = tmp_path / "sub-01_bold.json"
+    sidecar.write_text('{"RepetitionTime": 2.0, "EchoTime": NaN}')
+    metadata = _load_json(sidecar)
+    assert metadata["RepetitionTime"] == 2.0
+    assert np.isnan(metadata["EchoTime"])
+
+
+def test_clone_file(tmp_path):
+    """Test that _clone_file copies a file that can be changed independently of the original."""
+    src = tmp_path / "sub-01_bold.json"
+    src.write_text('{"RepetitionTime": 2.0}')
+    dst = tmp_path / "copy.json"
+    assert _clone_file(str(src), str(dst)) == str(dst)
+    assert dst.read_text() == src.read_text()
+    dst.write_text("{}")
+    assert src.read_text() == '{"RepetitionTime": 2.0}'
+
+
+def test_round_params():
+    """Test that round_params rounds to the requested precision without changing the config."""
+    config = {
+        "sidecar_params": {"func": {"EchoTime": {"precision": 3}}},
+        "derived_params": {"func": {"NSliceTimes": {}}},
+    }
+    param_group_df = pd.DataFrame({"EchoTime": [0.0301234, 0.0299876, np.nan]})
+    rounded = round_params(param_group_df, config, "func")
+    assert rounded["EchoTime"].tolist()[:2] == [0.03, 0.03]
+    assert np.isnan(rounded.loc[2, "EchoTime"])
+    assert "NSliceTimes" not in config["sidecar_params"]["func"]
+
+
+def test_format_params():
+    """Test that format_params clusters values with complete linkage."""
+    config = {
+        "sidecar_params": {"func": {"RepetitionTime": {"tolerance": 0.001}}},
+        "derived_params": {"func": {}},
+    }
+    param_group_df = pd.DataFrame({"RepetitionTime": [1.0, 1.0012, 1.0004, np.nan, 2.0]})
+    formatted = format_params(param_group_df, config, "func")
+    labels = formatted["Cluster_RepetitionTime"].tolist()
+
+    # 1.0 and 1.0004 are within tolerance, but 1.0012 is too far from 1.0 to join them,
+    # even though it is within tolerance of 1.0004
+    assert labels[0] == labels[2]
+    assert len(set(labels)) == 4
+    # The NaN placeholder doesn't leak into the data
+    assert np.isnan(formatted.loc[3, "RepetitionTime"])
+
+
+def test_precision_after_grouping():
+    """Test that values straddling a rounding boundary stay in one ParamGroup."""
+    entity_set = "datatype-dwi_suffix-dwi"
+    files = [f"/sub-0{i}/dwi/sub-0{i}_dwi.nii.gz" for i in range(1, 4)]
+    echo_times = [0.0304999, 0.0305001, 0.0305]
+    sidecars = {
+        path.replace(".nii.gz", ".json"): {"EchoTime": echo_time}
+        for path, echo_time in zip(files, echo_times)
+    }
+    labeled_files, param_groups = _get_param_groups(
+        files,
+        {path: [] for path in files},
+        entity_set,
+        load_config(None),
+        "dwi",
+        {entity_set: files},
+        sidecars=sidecars,
+    )
+
+    # the values are grouped as they are, and only rounded for reporting
+    assert labeled_files["ParamGroup"].tolist() == [1, 1, 1]
+    assert param_groups["EchoTime"].tolist() == [0.03]
+
+
 def test_entitysets(tmp_path):
     """Test entitysets."""
     data_root = get_data(tmp_path)
@@ -870,6 +950,24 @@ def test_session_apply(tmp_path):
     assert "session-" in mod1_content
 
 
+def test_session_entity_sets(tmp_path):
+    """Test that subject- and session-level instances on one path get their own entity sets."""
+    data_root = get_data(tmp_path)
+    non_key_entities = set(NON_KEY_ENTITIES)
+    NON_KEY_ENTITIES.add("session")
+    try:
+        sub_entity_sets = CuBIDS(data_root / "inconsistent").get_entity_sets()
+        ses_entity_sets = CuBIDS(
+            data_root / "inconsistent", acq_group_level="session"
+        ).get_entity_sets()
+    finally:
+        NON_KEY_ENTITIES.clear()
+        NON_KEY_ENTITIES.update(non_key_entities)
+
+    assert not any("session-" in entity_set for entity_set in sub_entity_sets)
+    assert all("session-" in entity_set for entity_set in ses_entity_sets)
+
+
 def test_remove_fields(tmp_path):
     """Test that we metadata fields are detected and removed."""
     data_root = get_data(tmp_path)
@@ -1,8 +1,24 @@
 """Miscellaneous utility functions for CuBIDS."""
 
+import json
+import os
 import re
+import shutil
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Linux ioctl request that makes a file share another file's data blocks (a "reflink")
+_FICLONE = 0x40049409
+
 
 def _get_container_type(image_name):
     """Get and return the container type.
@@ -31,3 +47,124 @@ def _get_container_type(image_name):
         return "docker"
 
     raise Exception("Unable to determine the container type of " + image_name)
+
+
+def _load_json(json_file):
+    """Load a JSON file, using orjson when it is installed.
+
+    Parameters
+    ----------
+    json_file : :obj:`str` or :obj:`pathlib.Path`
+        Path to the JSON file.
+
+    Returns
+    -------
+    :obj:`dict`
+        The parsed contents of the file.
+
+    Notes
+    -----
+    orjson is stricter than the standard library: it rejects ``NaN`` and ``Infinity``,
+    which show up in some sidecars. Files it can't parse are retried with :mod:`json`.
+    """
+    with open(json_file, "rb") as fo:
+        content = fo.read()
+
+    if orjson is not None:
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            pass
+
+    return json.loads(content)
+
+
+def _iter_bids_files(bids_dir, extensions):
+    """Find the files in a BIDS dataset's subject directories with the given extensions.
+
+    Only the ``sub-*`` directories at the root of the dataset are searched,
+    and hidden files and directories are skipped without being descended into.
+
+    Parameters
+    ----------
+    bids_dir : :obj:`str`
+        Path to the root of the BIDS dataset.
+    extensions : :obj:`str` or :obj:`tuple` of :obj:`str`
+        Extension(s) that the file names must end with.
+
+    Yields
+    ------
+    :obj:`str`
+        Path to each matching file.
+    """
+    with os.scandir(bids_dir) as entries:
+        directories = [
+            entry.path for entry in entries if entry.name.startswith("sub-") and entry.is_dir()
+        ]
+
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(extensions):
+                    yield entry.path
+
+
+def _iter_json_files(bids_dir):
+    """Find all JSON files in a dataset, without walking through its git directories.
+
+    Directories and files with ``.git`` in their names are skipped,
+    so the (potentially huge) git and git-annex object stores are never traversed.
+
+    Parameters
+    ----------
+    bids_dir : :obj:`str`
+        Path to the root of the BIDS dataset.
+
+    Yields
+    ------
+    :obj:`str`
+        Path to each JSON file.
+    """
+    for root, dirnames, filenames in os.walk(bids_dir):
+        dirnames[:] = [dirname for dirname in dirnames if ".git" not in dirname]
+        for filename in filenames:
+            if filename.endswith(".json") and ".git" not in filename:
+                yield os.path.join(root, filename)
+
+
+def _clone_file(src, dst):
+    """Copy a file, sharing its data blocks with the original when the filesystem allows it.
+
+    On copy-on-write filesystems (e.g., Btrfs or XFS) the copy is a reflink,
+    which takes constant time regardless of the file's size
+    and only uses new disk space once either file is modified.
+    Elsewhere this falls back to :func:`shutil.copy2`.
+    Unlike a hard link, writing to the copy never changes the original.
+
+    Parameters
+    ----------
+    src : :obj:`str`
+        Path to the file to copy.
+    dst : :obj:`str`
+        Path to the copy.
+
+    Returns
+    -------
+    :obj:`str`
+        Path to the copy, so this can be used as :func:`shutil.copytree`'s ``copy_function``.
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            pass
+        else:
+            shutil.copystat(src, dst)
+            return dst
+
+    return shutil.copy2(src, dst)
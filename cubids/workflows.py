@@ -69,8 +69,7 @@ def validate(
         # check if code/CuBIDS dir exists
         if not (bids_dir / "code" / "CuBIDS").is_dir():
             # if not, create it
-            subprocess.run(["mkdir", str(bids_dir / "code")])
-            subprocess.run(["mkdir", str(bids_dir / "code" / "CuBIDS")])
+            os.makedirs(bids_dir / "code" / "CuBIDS", exist_ok=True)
 
     # Run directly from python using subprocess
     if container is None: